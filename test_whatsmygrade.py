@@ -0,0 +1,55 @@
+import pytest
+
+from whatsmygrade import GradeFileParser, GradingScheme, UserError, helper_grade_multiple
+
+
+def test_min_value_for_unknown_agrees_with_compute_grade_at_boundary():
+    scheme = GradingScheme([
+        ("final", 0.35), ("midterm 1", 0.2), ("midterm 2", 0.2), ("homework", 0.25)
+    ])
+    known = {"midterm 1": 0.75, "midterm 2": 0.35, "homework": 0.61}
+
+    min_percent = scheme.get_min_value_for_unknown(["final"], known, 0.6)
+
+    # 65% in the final gives exactly 60%, which does not pass
+    assert min_percent == 66
+    assert scheme.compute_grade({**known, "final": 0.66}) > 0.6
+    assert not scheme.compute_grade({**known, "final": 0.65}) > 0.6
+
+
+def test_min_value_for_unknown_with_non_finite_known_grade():
+    scheme = GradingScheme([("a", 1), ("b", 1)])
+
+    assert scheme.get_min_value_for_unknown(["b"], {"a": float("inf")}, 0.5) == 0
+    assert scheme.get_min_value_for_unknown(["b"], {"a": float("-inf")}, 0.5) is None
+    assert scheme.get_min_value_for_unknown(["b"], {"a": float("nan")}, 0.5) is None
+
+
+def test_grade_multiple_accepts_any_iterable():
+    assert helper_grade_multiple((g for g in [8, 6, 7]), 10) == 0.7
+    assert helper_grade_multiple(map(float, [8, 6, 7]), 10, drop_worst=1) == 0.75
+
+
+def test_grade_multiple_out_of_zero_is_zero():
+    assert helper_grade_multiple([8, 6, 7], 0) == 0.0
+
+
+def test_grade_multiple_dropping_every_grade_is_zero():
+    assert helper_grade_multiple([8, 6, 7], 10, drop_worst=3) == 0.0
+    assert helper_grade_multiple([8, 6, 7], 10, use_best=2, drop_worst=5) == 0.0
+
+
+def test_parser_strips_space_before_colon_from_name():
+    parser = GradeFileParser()
+    parser._parse_file_lines(["[breakdown]", "final : 1", "[grades]", "final : 0.5"])
+
+    assert parser.grading_scheme.get_categories() == ["final"]
+    assert parser.grades == [("final", 0.5)]
+
+
+def test_parser_reports_missing_colon():
+    parser = GradeFileParser()
+
+    with pytest.raises(UserError) as err:
+        parser._parse_file_lines(["[grades]", "final = 50%"])
+    assert err.value.msg == "Expected colon"
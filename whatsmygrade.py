@@ -1,27 +1,46 @@
 import sys
 import os
 import re
+import math
+import array
+import functools
+import heapq
 from dataclasses import dataclass
-from typing import Any, Optional, Union, cast
-from termcolor import colored as _colored
+from typing import Any, Iterable, Optional, Union, cast
+
+_NUMBER_RE = re.compile(r"^[0-9]+(?:\.[0-9]+)?$")
+_PERCENT_RE = re.compile(r"^\d+(?:\.\d+)?%$")
+_NAME_RE = re.compile(r"[\w\- ]+")
 
 # helper functions
 
 
 def helper_grade_parts(*args: tuple[float, float]) -> float:
-    total_points = sum(arg[1] for arg in args)
-    points_earned = sum(arg[0] for arg in args)
+    total_points = 0.0
+    points_earned = 0.0
+    for earned, total in args:
+        total_points += total
+        points_earned += earned
     return points_earned / total_points
 
 
 def helper_grade_multiple(grades: list[float], out_of: float, use_best: Optional[int] = None, drop_worst: Optional[int] = None) -> float:
-    grades = sorted(grades, reverse=True)
+    grades = list(grades)
+    if out_of == 0 or not grades:
+        return 0.0
+
+    # work out how many of the top grades are kept, then select just those
+    keep = len(grades)
     if use_best:
-        grades = grades[:use_best]
+        keep = min(keep, use_best)
     if drop_worst:
-        grades = grades[:len(grades) - drop_worst]
-    if len(grades) == 0:
+        keep -= drop_worst
+    if keep <= 0:
         return 0.0
+
+    # nlargest returns the kept grades in descending order, so they are
+    # summed in the same order whether or not any were dropped
+    grades = heapq.nlargest(keep, grades)
     return sum(grades) / (out_of * len(grades))
 
 
@@ -33,13 +52,22 @@ class Config:
     use_color = True
 
 
+_ANSI = {
+    "cyan": "\x1b[36m",
+    "green": "\x1b[32m",
+    "red": "\x1b[31m",
+    "yellow": "\x1b[33m",
+}
+_RESET = "\x1b[0m"
+
+
 def colored(msg: Any, color: str) -> str:
-    msg = str(msg)
+    s = msg if isinstance(msg, str) else str(msg)
 
     if Config.use_color:
-        return _colored(msg, color)
+        return _ANSI[color] + s + _RESET
     else:
-        return msg
+        return s
 
 
 class UserError(Exception):
@@ -53,28 +81,29 @@ class UserError(Exception):
         self.offending_line = offending_line
 
 
-def weighted_average(data: list[tuple[float, float]]) -> float:
-    """
-    Return a weighted average for data, where each element of data takes the form
-    (value, weight)
-    """
-    if len(data) == 0:
-        return 0.0
-
-    sum_weights = sum(part[1] for part in data)
-    weighted_total = sum(part[0] * part[1] for part in data)
-    return weighted_total/sum_weights
-
-
 class GradingScheme:
-    _scheme: dict[str, float]
+    # categories are stored as a list of names and a parallel array of
+    # weights, with _index mapping each name to its position
     _name_order: list[str]
+    _weights: array.array
+    _index: dict[str, int]
+    _total_weight: float
 
     def __init__(self, scheme: list[tuple[str, float]]):
-        self._scheme = {
-            name: weight for name, weight in scheme
-        }
-        self._name_order = [name for name, _ in scheme]
+        self._name_order = []
+        self._weights = array.array("d")
+        self._index = {}
+
+        for name, weight in scheme:
+            # a repeated category keeps its first position and its last weight
+            if name in self._index:
+                self._weights[self._index[name]] = weight
+            else:
+                self._index[name] = len(self._name_order)
+                self._name_order.append(name)
+                self._weights.append(weight)
+
+        self._total_weight = sum(self._weights)
 
     def compute_grade(self, values: dict[str, float]) -> float:
         """
@@ -82,44 +111,127 @@ class GradingScheme:
         in the context of this grading scheme.
         """
 
-        data: list[tuple[float, float]] = []
+        missing = next((name for name in self._name_order if name not in values), None)
+        if missing is not None:
+            raise UserError('Missing grade entry for "{}"'.format(missing))
 
-        for name in self._scheme.keys():
-            weight = self._scheme[name]
-            value = values.get(name)
-            if value is None:
-                raise UserError('Missing grade entry for "{}"'.format(name))
-            data.append((value, weight))
+        if not self._name_order:
+            return 0.0
 
-        return weighted_average(data)
+        return sum(
+            values[name] * weight for name, weight in zip(self._name_order, self._weights)
+        ) / self._total_weight
     
     def get_min_value_for_unknown(self, unknowns: list[str], known_values: dict[str, float], passing: float) -> Optional[int]:
-        for min_percent in range(0, 101):
-            value = min_percent/100
+        """
+        Return the smallest whole percentage which, if scored in every unknown
+        category, would put the overall grade strictly above passing, or None
+        if even 100% is not enough.
+        """
 
-            values = {k:v for k,v in known_values.items()}
-            for u in unknowns:
-                values[u] = value
+        # the overall grade is linear in the unknown value x:
+        #   grade(x) = (known_total + x * unknown_weight) / total_weight
+        # so solve grade(x) > passing for x directly
+        unknown_set = set(unknowns)
+        total_weight = self._total_weight
+        unknown_weight = 0.0
+        known_total = 0.0
+
+        # every category must be either known or unknown; this is checked
+        # in the same pass that accumulates the weighted sums
+        for name, weight in zip(self._name_order, self._weights):
+            if name in unknown_set:
+                unknown_weight += weight
+                continue
+            value = known_values.get(name)
+            if value is None:
+                raise UserError('Missing grade entry for "{}"'.format(name))
+            known_total += value * weight
 
-            if self.compute_grade(values) > passing:
-                return min_percent
-        
-        return None
+        if total_weight == 0:
+            return None
+
+        def passes_with(percent: int) -> bool:
+            values = dict(known_values)
+            for u in unknown_set:
+                values[u] = percent / 100
+            return self.compute_grade(values) > passing
+
+        if unknown_weight == 0:
+            # the unknowns don't affect the grade at all
+            return 0 if passes_with(0) else None
+
+        threshold = (passing * total_weight - known_total) / unknown_weight
+        if math.isfinite(threshold):
+            min_percent = min(max(0, math.floor(threshold * 100) + 1), 101)
+        else:
+            # an infinite or nan known grade; start from an end of the range
+            # and let the settling below find the answer
+            min_percent = 101 if threshold > 0 else 0
+
+        # the closed form is only an estimate near the boundary, since it sums
+        # in a different order than compute_grade; settle the answer with
+        # compute_grade itself so that it agrees with the reported score
+        while min_percent > 0 and passes_with(min_percent - 1):
+            min_percent -= 1
+        while min_percent <= 100 and not passes_with(min_percent):
+            min_percent += 1
+
+        if min_percent > 100:
+            return None
+        return min_percent
 
     def get_categories(self) -> list[str]:
         return self._name_order[:]
 
     def get_weight(self, category_name: str) -> float:
-        return self._scheme[category_name]
+        return self._weights[self._index[category_name]]
     
     def get_weight_proportional(self, category_name: str) -> float:
-        return self._scheme[category_name] / sum(self._scheme.values())
+        return self.get_weight(category_name) / self._total_weight
+
+    def total_weight(self) -> float:
+        return self._total_weight
 
 
 class VariableGrade:
     pass
 
 
+# the single instance that "unknown" refers to in grade expressions
+_UNKNOWN = VariableGrade()
+
+# names available to grade expressions; each evaluation gets its own copy
+# so that assignments inside an expression cannot leak into later ones
+_EVAL_LOCALS: dict[str, Any] = {
+    # add helper functions
+    "grade_parts": helper_grade_parts,
+    "grade_multiple": helper_grade_multiple,
+    "percent": helper_percent,
+    "unknown": _UNKNOWN
+}
+
+
+@functools.lru_cache(maxsize=512)
+def _eval_expr(expr: str) -> Union[float, VariableGrade]:
+    """
+    Evaluate a (stripped) grade expression. Results are cached by expression
+    string, which is safe since they are floats or the shared _UNKNOWN.
+    """
+
+    # most entries are plain numbers or percentages; handle those
+    # without going through eval
+    if _NUMBER_RE.match(expr):
+        return float(expr)
+    if expr.endswith("%") and _PERCENT_RE.match(expr):
+        return float(expr[:-1]) / 100
+
+    try:
+        return eval(expr, {}, dict(_EVAL_LOCALS))
+    except SyntaxError:
+        raise UserError('Invalid expression "{}"'.format(expr))
+
+
 class GradeFileParser:
     grading_scheme: GradingScheme
     grades: list[tuple[str, Union[float, VariableGrade]]]
@@ -137,25 +249,9 @@ class GradeFileParser:
         self.has_been_parsed = False
 
     def eval_expr(self, expr: str) -> Union[float, VariableGrade]:
-        unknown = VariableGrade()
-        expr = expr.strip()
-        try:
-            if re.findall(r"^\d+(\.\d+)?%$", expr):
-                # expr is a percentage
-                return float(expr[:-1]) / 100
-            return eval(expr, {}, {
-                # add helper functions
-                "grade_parts": helper_grade_parts,
-                "grade_multiple": helper_grade_multiple,
-                "percent": helper_percent,
-                "unknown": unknown
-            })
-        except SyntaxError:
-            raise UserError('Invalid expression "{}"'.format(expr))
-
-    def _parse_file_content(self, content: str) -> None:
-        lines = content.split("\n")
+        return _eval_expr(expr.strip())
 
+    def _parse_file_lines(self, lines: Iterable[str]) -> None:
         mode: Optional[str] = None
         scheme: list[tuple[str, float]] = []
 
@@ -173,30 +269,29 @@ class GradeFileParser:
                 if not mode:
                     raise UserError('Unexpected statement "{}"'.format(line))
 
-                name_match = re.findall(r"^[\w\- ]+", line)
-                if not name_match:
-                    raise UserError("Missing value name", offending_line=line)
-
-                value_name: str = name_match[0]
-                # remove the value name from the start of the line
-                assert line.startswith(value_name)
-                line = line[len(value_name):]
+                value_name, colon, expr = line.partition(":")
 
-                # there should be a colon at the new start of the line
-                if not line.startswith(":"):
+                # there should be a colon following the value name
+                if not colon:
                     raise UserError("Expected colon", offending_line=line)
-                line = line[1:]  # remove the colon
+
+                value_name = value_name.rstrip()
+                if value_name == "":
+                    raise UserError("Missing value name", offending_line=line)
+                if not _NAME_RE.fullmatch(value_name):
+                    raise UserError("Invalid value name", offending_line=line)
 
                 # there should be an expression
-                if line == "":
+                expr = expr.strip()
+                if expr == "":
                     raise UserError(
                         "Expected expression following a colon", offending_line=line)
 
-                value = self.eval_expr(line)
+                value = self.eval_expr(expr)
 
                 # now, we do something with the value_name: value pair we just got
                 if mode == "breakdown":
-                    if isinstance(value, float) or isinstance(value, int):
+                    if isinstance(value, (float, int)):
                         scheme.append((value_name, value))
                     else:
                         raise UserError("Invalid weight", offending_line=line)
@@ -218,59 +313,80 @@ class GradeFileParser:
             raise UserError('Cannot find file with path "{}"'.format(path))
 
         with open(path) as fl:
-            self._parse_file_content(fl.read())
+            self._parse_file_lines(fl)
 
         self.has_been_parsed = True
 
     def grade_summary(self) -> None:
-        print("===== GRADE SUMMARY =====")
+        # the summary is collected and written out in one go; whatever was
+        # built is still written if an error interrupts it part way through
+        lines: list[str] = []
+        try:
+            self._build_summary(lines)
+        finally:
+            sys.stdout.write("".join(line + "\n" for line in lines))
+
+    def _build_summary(self, lines: list[str]) -> None:
+        lines.append("===== GRADE SUMMARY =====")
         categories = self.grading_scheme.get_categories()
-        grades = {category: value for category, value in self.grades}
-        col_left = [
-            colored(category_name, "cyan") + " ({}%)".format(
+
+        # a category entered more than once takes its last value
+        present = dict(self.grades)
+
+        # partition the entered grades in a single pass
+        knowns: dict[str, float] = {}
+        unknowns: list[str] = []
+        for category, value in present.items():
+            if isinstance(value, VariableGrade):
+                unknowns.append(category)
+            else:
+                knowns[category] = value
+
+        # alignment is computed from the uncolored text, since the color
+        # escape codes take up no space on screen
+        col_left: list[str] = []
+        col_left_widths: list[int] = []
+        for category_name in categories:
+            weight_text = " ({}%)".format(
                 round(self.grading_scheme.get_weight_proportional(category_name) * 100)
             )
-            for category_name in categories
-        ]
+            col_left.append(colored(category_name, "cyan") + weight_text)
+            col_left_widths.append(len(category_name) + len(weight_text))
         col_right = []
         for category in categories:
-            if category not in grades:
+            if category not in present:
                 col_right.append(colored("(unspecified)", "red"))
+            elif category in knowns:
+                value = knowns[category]
+                col_right.append(colored("{:.2f}%".format(value*100), "green" if value >= self.passing_grade else "red"))
             else:
-                value = grades[category]
-
-                if isinstance(value, VariableGrade):
-                    col_right.append(colored("unknown", "yellow"))
-                else:
-                    col_right.append(colored("{:.2f}%".format(value*100), "green" if value >= self.passing_grade else "red"))
+                col_right.append(colored("unknown", "yellow"))
 
-        col_left_size = max(len(s) for s in col_left)+1
+        col_left_size = max(col_left_widths, default=0)+1
 
-        for left, right in zip(col_left, col_right):
-            print(left + ":" + (" "*(col_left_size - len(left))) + right)
+        for left, width, right in zip(col_left, col_left_widths, col_right):
+            lines.append(left + ":" + (" "*(col_left_size - width)) + right)
 
-        unknowns = [name for name, value in grades.items() if isinstance(value, VariableGrade)]
-        knowns = {name:value for name, value in grades.items() if not isinstance(value, VariableGrade)}
         if len(unknowns) > 0:
             minimum_grade_percent = self.grading_scheme.get_min_value_for_unknown(unknowns, knowns, self.passing_grade)
 
             if minimum_grade_percent is not None:
-                print("To pass the course with a {}, you would need, at minimum, a {} in {}.".format(
+                lines.append("To pass the course with a {}, you would need, at minimum, a {} in {}.".format(
                     colored(str(self.passing_grade*100)+"%", "green"),
                     colored(str(minimum_grade_percent)+"%", "cyan"),
                     ", ".join(colored(u, "cyan") for u in unknowns)
                 ))
             else:
-                print("You would not be able the course with a {}, even with a perfect score (100) in {}.".format(
+                lines.append("You would not be able the course with a {}, even with a perfect score (100) in {}.".format(
                     colored(str(self.passing_grade*100)+"%", "green"),
                     ", ".join(colored(u, "cyan") for u in unknowns)
                 ))
         
         else:
-            computed_score = self.grading_scheme.compute_grade(cast(Any, grades))
-            print()
-            print("===== OVERALL SCORE =====")
-            print(colored(
+            computed_score = self.grading_scheme.compute_grade(knowns)
+            lines.append("")
+            lines.append("===== OVERALL SCORE =====")
+            lines.append(colored(
                 "          {:.2f}%         ".format(computed_score*100),
                 "green" if computed_score > self.passing_grade else "red"
             ))